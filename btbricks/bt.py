@@ -28,7 +28,25 @@
 import struct
 
 try:
-    from utime import sleep_ms, ticks_diff, ticks_ms
+    from utime import sleep_ms, ticks_add, ticks_diff, ticks_ms
+except ImportError:
+    # Polyfill for automated testing purposes
+    from time import monotonic, sleep
+
+    def sleep_ms(ms):
+        sleep(ms / 1000)
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_add(ticks, delta):
+        return ticks + delta
+
+    def ticks_diff(ticks1, ticks2):
+        return ticks1 - ticks2
+
+
+try:
     from micropython import const, schedule, alloc_emergency_exception_buf
     import ubluetooth
 
@@ -54,9 +72,17 @@ except:
 
     print("Import failed. Not on micropython?")
 
+try:
+    from weakref import WeakMethod
+except ImportError:
+    # MicroPython has no weakref. Callbacks are held by strong references there.
+    WeakMethod = None
+
 
 TARGET_MTU = const(184)  # Try to negotiate this packet size for UART
 MAX_NOTIFY = const(100)  # Somehow notify with the full mtu is unstable. Memory issue?
+_CONNECT_POLL_MS = const(50)  # Check this often whether the IRQ handler finished connecting
+_NO_HANDLES = (None, None, None)  # connect_uart() result when no peripheral was connected
 
 
 L_STICK_HOR = const(0)
@@ -94,6 +120,40 @@ _IRQ_GATTC_WRITE_DONE = const(17)
 _IRQ_GATTC_READ_DONE = const(16)
 _IRQ_MTU_EXCHANGED = const(21)
 
+# Per-connection callback slots: [conn_handle, notify, write_done, disconnect, mtu]
+_MAX_CONN = const(4)  # Slots preallocated at reset. More are added when needed.
+_NO_CONN = const(-1)
+_SLOT_HANDLE = const(0)
+_SLOT_NOTIFY = const(1)
+_SLOT_WRITE_DONE = const(2)
+_SLOT_DISCONN = const(3)
+_SLOT_MTU = const(4)
+_DEFAULT_MTU = const(20)  # Payload bytes per packet before an MTU exchange
+
+# Indices of the handler-wide callbacks in BLEHandler._singletons
+_CB_CENTRAL_CONN = const(0)
+_CB_CENTRAL_DISCONN = const(1)
+_CB_SCAN_RESULT = const(2)
+_CB_SCAN_DONE = const(3)
+_CB_CHAR_RESULT = const(4)
+_CB_COUNT = const(5)
+
+# Byte offsets of the uint16 GATT handles packed in a ConnectionContext
+_CTX_CONN = const(0)
+_CTX_START = const(2)
+_CTX_END = const(4)
+_CTX_UART_RX = const(6)
+_CTX_UART_TX = const(8)
+_CTX_LEGO = const(10)
+_CTX_SIZE = const(12)
+_NO_HANDLE = const(0xFFFF)  # Not a valid HCI connection or attribute handle
+_CTX_EMPTY = b"\xff" * _CTX_SIZE
+_CTX_UART_EMPTY = b"\xff" * _CTX_LEGO  # Everything up to the LEGO hub handle
+_CTX_POOL_SIZE = const(4)
+
+# Released ConnectionContext instances, reused by ConnectionContext.acquire()
+_CTX_POOL = []
+
 
 # Helpers for generating BLE advertising payloads.
 # Advertising payloads are repeated packets of the following form:
@@ -286,6 +346,152 @@ def _decode_services(payload):
     return services
 
 
+def _wrap(callback, table, key):
+    """
+    Wrap a bound method in a weak reference before storing it in ``table[key]``,
+    so a registered callback does not keep its owner alive. When the owner is
+    garbage collected, the entry is cleared. Plain functions are stored as is.
+
+    :param callback: The callback to store.
+    :param table: The list or dict the callback will be stored in.
+    :param key: The index or key of the callback in the table.
+    :return: The entry to store in the table.
+    """
+    if WeakMethod is None or not hasattr(callback, "__func__"):
+        return callback
+
+    def _forget(ref):
+        try:
+            if table[key] is ref:
+                if isinstance(table, dict):
+                    del table[key]
+                else:
+                    table[key] = None
+        except (KeyError, IndexError):
+            pass
+
+    return WeakMethod(callback, _forget)
+
+
+def _resolve(entry):
+    """
+    Return the callable behind a stored callback entry, or None if its owner is gone.
+    Without WeakMethod every entry is the callable itself, so the IRQ handler
+    only calls this when WeakMethod is available.
+    """
+    if WeakMethod is not None and isinstance(entry, WeakMethod):
+        return entry()
+    return entry
+
+
+def _no_match(name, services):
+    return False
+
+
+def _is_lego_hub(name, services):
+    return _LEGO_SERVICE_UUID in services
+
+
+def _handle_property(offset):
+    return property(
+        lambda self: self._get(offset),
+        lambda self, value: self._set(offset, value),
+    )
+
+
+class ConnectionContext:
+    """
+    State of a connection that a central is setting up: the discovered peripheral
+    and the GATT handles found on it. The handles are packed as uint16 values in a
+    single bytearray. Handles that are not known yet read as ``None``.
+    The peripheral address is copied into a preallocated buffer and is only
+    valid while ``addr_type`` is not ``None``.
+    """
+
+    __slots__ = ("_h", "addr_type", "addr", "adv_type", "name", "services")
+
+    def __init__(self):
+        self._h = bytearray(_CTX_SIZE)
+        self.addr = bytearray(6)
+        self.reset()
+
+    @classmethod
+    def acquire(cls):
+        """
+        Get a reset context from the pool, or a new one if the pool is empty.
+        Not safe to call from an IRQ handler.
+        """
+        return _CTX_POOL.pop() if _CTX_POOL else cls()
+
+    def release(self):
+        """Reset the context and return it to the pool. Don't use it afterwards."""
+        self.reset()
+        if len(_CTX_POOL) < _CTX_POOL_SIZE:
+            _CTX_POOL.append(self)
+
+    def reset(self):
+        """Forget the peripheral and all its handles."""
+        self._h[:] = _CTX_EMPTY
+        self.addr_type = None
+        self.adv_type = None
+        self.name = None
+        self.services = None
+
+    def reset_uart(self):
+        """
+        Forget the peripheral, its discovery and its UART handles. Keeps the
+        LEGO hub handle, so a hub connected earlier can still be written to.
+        """
+        self._h[:_CTX_LEGO] = _CTX_UART_EMPTY
+        self.addr_type = None
+        self.adv_type = None
+        self.name = None
+        self.services = None
+
+    def _get(self, offset):
+        value = self._h[offset] | self._h[offset + 1] << 8
+        return None if value == _NO_HANDLE else value
+
+    def _set(self, offset, value):
+        if value is None:
+            value = _NO_HANDLE
+        self._h[offset] = value & 0xFF
+        self._h[offset + 1] = value >> 8
+
+    def set_address(self, addr_type, addr):
+        """Remember the peripheral address. The addr buffer of the IRQ is copied."""
+        self.addr_type = addr_type
+        self.addr[:] = addr
+
+    conn_handle = _handle_property(_CTX_CONN)
+    start_handle = _handle_property(_CTX_START)
+    end_handle = _handle_property(_CTX_END)
+    uart_rx_handle = _handle_property(_CTX_UART_RX)
+    uart_tx_handle = _handle_property(_CTX_UART_TX)
+    lego_value_handle = _handle_property(_CTX_LEGO)
+
+    def handles(self):
+        """The conn_handle, uart_rx_handle and uart_tx_handle in one call."""
+        get = self._get
+        return get(_CTX_CONN), get(_CTX_UART_RX), get(_CTX_UART_TX)
+
+    def has_discovery_handles(self):
+        """True when the start and end handles of the requested service are known."""
+        return self.start_handle is not None and self.end_handle is not None
+
+    def is_uart_ready(self):
+        """True when the connection and both UART characteristics are known."""
+        return (
+            self.conn_handle is not None
+            and self.uart_rx_handle is not None
+            and self.uart_tx_handle is not None
+        )
+
+    def is_lego_ready(self):
+        """True when the connection and the LEGO hub characteristic are known."""
+        return self.conn_handle is not None and self.lego_value_handle is not None
+
+
 class BLEHandler:
     """
     Basic Bluetooth Low Energy class that can be a central or peripheral or both.
@@ -302,7 +508,7 @@ class BLEHandler:
         self._ble.active(True)
         try:
             self._ble.gap_disconnect(1025)  # Disconnect in case of previous crash
-        except:
+        except OSError:
             pass
         self._ble.irq(self._irq)
         self.debug = debug
@@ -311,22 +517,27 @@ class BLEHandler:
 
     def _reset(self):
         self._connected_central = -1  # Only one central can connect. -1 is not connected.
-        self._scan_result_callback = None
-        self._scan_done_callback = None
-        self._write_done_callbacks = {}
-        self._disconn_callbacks = {}
-        self._central_conn_callback = None  # Used when centrals connect
-        self._central_disconn_callback = None  # Used when centrals disconnect
-        self._char_result_callback = None
+        # Handler-wide callbacks, indexed by the _CB_ constants.
+        self._singletons = [None] * _CB_COUNT
+        # Fixed table of callback slots, looked up by conn_handle without hashing.
+        self._conn_slots = [[_NO_CONN, None, None, None, _DEFAULT_MTU] for _ in range(_MAX_CONN)]
         self._write_callbacks = {}
-        self._notify_callbacks = {}
+        # Bound once, so the GATTS write IRQ skips the attribute and method lookup.
+        self._write_callbacks_get = self._write_callbacks.get
         self._search_name = None
+        # Filter for advertisements while connecting: fn(name, services)
+        self._scan_match = _no_match
         self.connecting_uart = False
         self.connecting_lego = False
+        self._uart_callbacks = None  # Registered when a pending UART connection is done
+        self._connect_deadline = 0
         self._read_data = {}
-        self._start_handle = None
-        self._end_handle = None
-        self.mtu = 20
+        self._connection = ConnectionContext.acquire()
+        self.mtu = _DEFAULT_MTU  # Last negotiated mtu, on any connection
+        self._mtu_exchanged = False
+        self._mtu_conn = _NO_CONN  # The connection _negotiate_mtu() waits for
+        self._mtu_configured = False
+        self._scanning = False
         if self.debug:
             # Reserve log_size bytes and track the index of the last written byte.
             self.log_data = bytearray(self.log_size)
@@ -363,14 +574,112 @@ class BLEHandler:
             else:
                 self.log_idx = 0
 
-    def print_log(self):
-        """Prints the log to the console and clears it."""
-        for l in self.log_data[self.log_idx :].decode("utf8").split("\n"):
-            print(l)
-        for l in self.log_data[: self.log_idx].decode("utf8").split("\n"):
-            print(l)
+    def drain_log(self):
+        """
+        Returns the log, oldest messages first, and clears it.
+
+        :return: Log messages separated by newlines. Empty if debug is disabled.
+        :rtype: bytes
+        """
+        if not self.debug:
+            return b""
+        log_data = self.log_data
+        idx = self.log_idx
+        # The log is a ring buffer. Unused bytes are zero.
+        # MicroPython bytearrays have no replace(), so join them as bytes.
+        log = (bytes(log_data[idx:]) + bytes(log_data[:idx])).replace(b"\x00", b"")
         self.log_data = bytearray(self.log_size)
         self.log_idx = 0
+        return log
+
+    def print_log(self):
+        """Prints the log to the console and clears it."""
+        # One print for the whole log instead of one per line.
+        print(self.drain_log().decode("utf8"), end="")
+
+    def _conn_slot(self, conn_handle):
+        """
+        Find the callback slot of a connection. This runs in the IRQ handler
+        for every notification, so it does nothing but compare handles.
+
+        :param conn_handle: The handle of the connection.
+        :type conn_handle: int
+        :return: The slot list, or None if the connection has no callbacks.
+        """
+        for slot in self._conn_slots:
+            if slot[_SLOT_HANDLE] == conn_handle:
+                return slot
+        return None
+
+    def _claim_slot(self, conn_handle):
+        """Find the callback slot of a connection, or claim a free one for it."""
+        slot = self._conn_slot(conn_handle)
+        if slot is None:
+            slot = self._conn_slot(_NO_CONN)
+            if slot is None:
+                slot = [_NO_CONN, None, None, None, _DEFAULT_MTU]
+                self._conn_slots.append(slot)
+            slot[_SLOT_HANDLE] = conn_handle
+        return slot
+
+    def _set_conn_callback(self, conn_handle, idx, callback):
+        slot = self._claim_slot(conn_handle)
+        slot[idx] = _wrap(callback, slot, idx)
+
+    def _register_conn_callbacks(self, conn_handle, notify=None, disconnect=None, write_done=None):
+        """Set all callbacks of a new connection with a single slot lookup."""
+        slot = self._claim_slot(conn_handle)
+        slot[_SLOT_NOTIFY] = _wrap(notify, slot, _SLOT_NOTIFY)
+        slot[_SLOT_DISCONN] = _wrap(disconnect, slot, _SLOT_DISCONN)
+        slot[_SLOT_WRITE_DONE] = _wrap(write_done, slot, _SLOT_WRITE_DONE)
+        slot[_SLOT_MTU] = _DEFAULT_MTU
+
+    def conn_mtu(self, conn_handle):
+        """
+        The mtu negotiated on a connection with callbacks, like the ones made by
+        :meth:`connect_uart`. Unlike ``self.mtu``, this is never the size accepted
+        by another peer.
+
+        :param conn_handle: The handle of the connection.
+        :type conn_handle: int
+        :return: The number of payload bytes per packet.
+        """
+        slot = self._conn_slot(conn_handle)
+        return slot[_SLOT_MTU] if slot else _DEFAULT_MTU
+
+    @staticmethod
+    def _free_slot(slot):
+        slot[_SLOT_HANDLE] = _NO_CONN
+        slot[_SLOT_NOTIFY] = None
+        slot[_SLOT_WRITE_DONE] = None
+        slot[_SLOT_DISCONN] = None
+        slot[_SLOT_MTU] = _DEFAULT_MTU
+
+    def _clear_connection(self, conn_handle):
+        """Release the callback slot of a connection so it can be reused."""
+        slot = self._conn_slot(conn_handle)
+        if slot:
+            self._free_slot(slot)
+        self._sweep()
+
+    def _sweep(self):
+        """
+        Drop callbacks whose owner has been garbage collected. Frees the slots
+        that have no live callbacks left and shrinks the slot table back to
+        its preallocated size when the extra slots are free.
+        """
+        for slot in self._conn_slots:
+            if slot[_SLOT_HANDLE] != _NO_CONN and not (
+                _resolve(slot[_SLOT_NOTIFY])
+                or _resolve(slot[_SLOT_WRITE_DONE])
+                or _resolve(slot[_SLOT_DISCONN])
+            ):
+                self._free_slot(slot)
+        slots = self._conn_slots
+        while len(slots) > _MAX_CONN and slots[-1][_SLOT_HANDLE] == _NO_CONN:
+            slots.pop()
+        for value_handle in [h for h, cb in self._write_callbacks.items() if not _resolve(cb)]:
+            del self._write_callbacks[value_handle]
 
     def _irq(self, event, data):
         if event == _IRQ_SCAN_RESULT:
@@ -379,85 +688,101 @@ class BLEHandler:
             services = _decode_services(adv_data)
             # self.info(self._search_payload == adv_data) # This works TODO: Implement properly
             self.info("Found: ", name, " with services: ", services)
-            if self.connecting_uart:
-                if name == self._search_name and _UART_UUID in services:
-                    # Found a potential device, remember it
-                    self._addr_type = addr_type
-                    self._addr = bytes(
-                        addr
-                    )  # Note: addr buffer is owned by caller so need to copy it.
-                    # ... and stop scanning. This triggers the IRQ_SCAN_DONE and the on_scan callback.
-                    self.stop_scan()
-            if self.connecting_lego:
-                if _LEGO_SERVICE_UUID in services:
-                    self._addr_type = addr_type
-                    self._addr = bytes(addr)
-                    self._adv_type = adv_type
-                    self._name = _decode_name(adv_data)
-                    self._services = _decode_services(adv_data)
-                    self.stop_scan()
-            if self._scan_result_callback:
-                self._scan_result_callback(addr_type, addr, name, services)
+            if self._scan_match(name, services):
+                # Found a potential device, remember it
+                self._scan_match = _no_match
+                ctx = self._connection
+                # Note: addr buffer is owned by caller so need to copy it.
+                ctx.set_address(addr_type, addr)
+                ctx.adv_type = adv_type
+                ctx.name = name
+                ctx.services = services
+                # ... and stop scanning. This triggers the IRQ_SCAN_DONE and the on_scan callback.
+                self.stop_scan()
+            callback = self._singletons[_CB_SCAN_RESULT]
+            if WeakMethod:
+                callback = _resolve(callback)
+            if callback:
+                callback(addr_type, addr, name, services)
 
         elif event == _IRQ_SCAN_DONE:
+            self._scanning = False
+            ctx = self._connection
             if self.connecting_uart:
-                if self._addr_type is not None:
+                if ctx.addr_type is not None:
                     print("Found peripheral:", self._search_name)
                     sleep_ms(500)
-                    self._ble.gap_connect(self._addr_type, self._addr)
+                    self._ble.gap_connect(ctx.addr_type, ctx.addr)
                 else:
                     self.connecting_uart = False
                     self.info("No uart peripheral '{}' found.".format(self._search_name))
             elif self.connecting_lego:
-                if self._addr_type is not None:
-                    print("Found SMART Hub:", self._name)
+                if ctx.addr_type is not None:
+                    print("Found SMART Hub:", ctx.name)
                     sleep_ms(500)
-                    self._ble.gap_connect(self._addr_type, self._addr)
+                    self._ble.gap_connect(ctx.addr_type, ctx.addr)
                 else:
                     self.connecting_lego = False
                     self.info("LEGO Smart hub found.")
-            if self._scan_done_callback:
-                self._scan_done_callback(data)
+            callback = self._singletons[_CB_SCAN_DONE]
+            if WeakMethod:
+                callback = _resolve(callback)
+            if callback:
+                callback(data)
 
         elif event == _IRQ_PERIPHERAL_CONNECT:
             # Connect to peripheral successful.
             conn_handle, addr_type, addr = data
             if self.connecting_uart or self.connecting_lego:
-                self._conn_handle = conn_handle
+                self._connection.conn_handle = conn_handle
             self._ble.gattc_discover_services(conn_handle)
 
         elif event == _IRQ_PERIPHERAL_DISCONNECT:
             # Disconnect (either initiated by us or the remote end).
             conn_handle, _, _ = data
-            if conn_handle in self._disconn_callbacks:
-                if self._disconn_callbacks[conn_handle]:
-                    self._disconn_callbacks[conn_handle]()
-                    # TODO Also delete any notify callbacks
+            if conn_handle == self._connection.conn_handle:
+                self._connection.conn_handle = None
+            slot = self._conn_slot(conn_handle)
+            if slot:
+                callback = slot[_SLOT_DISCONN]
+                if WeakMethod:
+                    callback = _resolve(callback)
+                # Drop all callbacks, the conn_handle can be reused by a new connection.
+                self._clear_connection(conn_handle)
+                if callback:
+                    callback()
 
         elif event == _IRQ_GATTC_SERVICE_RESULT:
             # Connected device returned a service.
             conn_handle, start_handle, end_handle, uuid = data
             if uuid == _UART_UUID or uuid == _LEGO_SERVICE_UUID:
                 # Save handles until SERVICE_DONE
-                self._start_handle = start_handle
-                self._end_handle = end_handle
+                self._connection.start_handle = start_handle
+                self._connection.end_handle = end_handle
 
         elif event == _IRQ_GATTC_SERVICE_DONE:
             # Service query complete.
-            if self._start_handle and self._end_handle:
+            ctx = self._connection
+            if ctx.has_discovery_handles():
                 self._ble.gattc_discover_characteristics(
-                    self._conn_handle, self._start_handle, self._end_handle
+                    ctx.conn_handle, ctx.start_handle, ctx.end_handle
                 )
             else:
                 self.info("Failed to find requested gatt service.")
 
         elif event == _IRQ_MTU_EXCHANGED:
-            # A remote central negotiated a new mtu
+            # The mtu was negotiated, by a remote central or after our own request.
             # Store it to control large transfers
             # TODO: find out if mtu is conn_handle dependent...
             # Let's assume it isn't.
             conn_handle, mtu = data
-            self.mtu = mtu
+            self.mtu = mtu - 4  # Some overhead bytes in max msg size.
+            slot = self._conn_slot(conn_handle)
+            if slot:
+                slot[_SLOT_MTU] = mtu - 4
+            if conn_handle == self._mtu_conn:
+                # Not an exchange started by a remote central on the peripheral side.
+                self._mtu_exchanged = True
             self.info("Mtu:", mtu)
 
         elif event == _IRQ_GATTC_CHARACTERISTIC_RESULT:
@@ -465,17 +790,20 @@ class BLEHandler:
             conn_handle, def_handle, value_handle, properties, uuid = data
             if self.connecting_uart:
                 if uuid == _UART_RX_UUID:
-                    self._rx_handle = value_handle
+                    self._connection.uart_rx_handle = value_handle
                 elif uuid == _UART_TX_UUID:
-                    self._tx_handle = value_handle
-                if all((self._conn_handle, self._rx_handle, self._tx_handle)):
+                    self._connection.uart_tx_handle = value_handle
+                if self._connection.is_uart_ready():
                     self.connecting_uart = False
             elif self.connecting_lego:
                 if uuid == _LEGO_SERVICE_CHAR:
-                    self._lego_value_handle = value_handle
+                    self._connection.lego_value_handle = value_handle
                     self.connecting_lego = False  # We're done
-            if self._char_result_callback:
-                self._char_result_callback(conn_handle, value_handle, uuid)
+            callback = self._singletons[_CB_CHAR_RESULT]
+            if WeakMethod:
+                callback = _resolve(callback)
+            if callback:
+                callback(conn_handle, value_handle, uuid)
 
         elif event == _IRQ_GATTC_WRITE_DONE:
             # This event fires in a central, when it is done writing
@@ -484,16 +812,23 @@ class BLEHandler:
             # The callback function should check for the value handle.
             conn_handle, value_handle, status = data
             self.info("Write done on", conn_handle, "in value", value_handle)
-            if conn_handle in self._write_done_callbacks:
-                self._write_done_callbacks[conn_handle](value_handle, status)
+            slot = self._conn_slot(conn_handle)
+            callback = slot[_SLOT_WRITE_DONE] if slot else None
+            if WeakMethod:
+                callback = _resolve(callback)
+            if callback:
+                callback(value_handle, status)
 
         elif event == _IRQ_GATTC_NOTIFY:
             conn_handle, value_handle, notify_data = data
             notify_data = bytes(notify_data)
             self.info("Notify:", conn_handle, value_handle, notify_data)
-            if conn_handle in self._notify_callbacks:
-                if self._notify_callbacks[conn_handle]:
-                    schedule(self._notify_callbacks[conn_handle], notify_data)
+            slot = self._conn_slot(conn_handle)
+            callback = slot[_SLOT_NOTIFY] if slot else None
+            if WeakMethod:
+                callback = _resolve(callback)
+            if callback:
+                schedule(callback, notify_data)
 
         elif event == _IRQ_GATTC_READ_RESULT:
             # A read completed successfully and returns data
@@ -506,15 +841,21 @@ class BLEHandler:
             conn_handle, addr_type, addr = data
             self.info("New connection ", conn_handle)
             self._connected_central = conn_handle
-            if self._central_conn_callback:
-                self._central_conn_callback(*data)
+            callback = self._singletons[_CB_CENTRAL_CONN]
+            if WeakMethod:
+                callback = _resolve(callback)
+            if callback:
+                callback(*data)
 
         elif event == _IRQ_CENTRAL_DISCONNECT:
             conn_handle, addr_type, addr = data
             self.info("Disconnected ", conn_handle)
             self._connected_central = -1
-            if self._central_disconn_callback:
-                self._central_disconn_callback(conn_handle)
+            callback = self._singletons[_CB_CENTRAL_DISCONN]
+            if WeakMethod:
+                callback = _resolve(callback)
+            if callback:
+                callback(conn_handle)
 
         elif event == _IRQ_GATTS_WRITE:
             # A client/central has written to a characteristic or descriptor.
@@ -522,9 +863,11 @@ class BLEHandler:
             conn_handle, value_handle = data
             value = self._ble.gatts_read(value_handle)
             self.info("Client/central wrote:", conn_handle, value)
-            if value_handle in self._write_callbacks:
-                if self._write_callbacks[value_handle]:
-                    self._write_callbacks[value_handle](value)
+            callback = self._write_callbacks_get(value_handle)
+            if WeakMethod:
+                callback = _resolve(callback)
+            if callback:
+                callback(value)
 
         else:
             self.info("Unhandled event: ", hex(event), "data:", data)
@@ -546,7 +889,55 @@ class BLEHandler:
         :param callback: The callback function to call when a client writes to the characteristic or descriptor.
         :type callback: function
         """
-        self._write_callbacks[value_handle] = callback
+        self._write_callbacks[value_handle] = _wrap(callback, self._write_callbacks, value_handle)
+
+    def _set_singleton(self, idx, callback):
+        self._singletons[idx] = _wrap(callback, self._singletons, idx)
+
+    def on_central_connect(self, callback):
+        """
+        Register a peripheral (server) callback for when a central connects.
+
+        :param callback: Called with ``conn_handle, addr_type, addr``.
+        :type callback: function
+        """
+        self._set_singleton(_CB_CENTRAL_CONN, callback)
+
+    def on_central_disconnect(self, callback):
+        """
+        Register a peripheral (server) callback for when a central disconnects.
+
+        :param callback: Called with ``conn_handle``.
+        :type callback: function
+        """
+        self._set_singleton(_CB_CENTRAL_DISCONN, callback)
+
+    def on_scan_result(self, callback):
+        """
+        Register a callback for every advertisement found while scanning.
+
+        :param callback: Called with ``addr_type, addr, name, services``. The addr buffer is only valid during the call.
+        :type callback: function
+        """
+        self._set_singleton(_CB_SCAN_RESULT, callback)
+
+    def on_scan_done(self, callback):
+        """
+        Register a callback for when scanning has stopped.
+
+        :param callback: Called with the scan done event data.
+        :type callback: function
+        """
+        self._set_singleton(_CB_SCAN_DONE, callback)
+
+    def on_char_result(self, callback):
+        """
+        Register a central (client) callback for every characteristic discovered on a peripheral.
+
+        :param callback: Called with ``conn_handle, value_handle, uuid``.
+        :type callback: function
+        """
+        self._set_singleton(_CB_CHAR_RESULT, callback)
 
     def on_write_done(self, conn_handle, callback):
         """
@@ -558,7 +949,7 @@ class BLEHandler:
         :param callback: The callback function to call when a client writes to the characteristic or descriptor.
         :type callback: function
         """
-        self._write_done_callbacks[conn_handle] = callback
+        self._set_conn_callback(conn_handle, _SLOT_WRITE_DONE, callback)
 
     def notify(self, data, val_handle, conn_handle=None):
         """
@@ -583,6 +974,7 @@ class BLEHandler:
         """
         Start scanning for BLE peripherals. Scan results will be returned in the IRQ handler.
         """
+        self._scanning = True
         self._ble.gap_scan(20000, 30000, 30000)
 
     def stop_scan(self):
@@ -596,7 +988,8 @@ class BLEHandler:
     ):
         """
         Connect to a BLE Peripheral that advertises with a certain name, and has a UART service.
-        This method is meant for BLE Centrals
+        This method is meant for BLE Centrals. It blocks until connected, or until time_out
+        seconds passed. Use :meth:`start_connect_uart` to connect without blocking.
 
         :param name: The name of the peripheral to search for and connect to
         :type name: str
@@ -606,86 +999,195 @@ class BLEHandler:
         :type on_notify: function
         :param on_write_done: Callback function to call when the peripheral is done writing to the central
         :type on_write_done: function
+        :param time_out: Seconds to search and connect
+        :type time_out: int
+        :return: conn_handle, rx_handle, tx_handle. All None if no peripheral was connected,
+            or if another connection attempt is still running.
+        """
+        if not self.start_connect_uart(name, on_disconnect, on_notify, on_write_done, time_out):
+            return _NO_HANDLES
+        try:
+            self._wait_connecting(self._connect_deadline)
+            return self.poll_connect_uart()
+        finally:
+            if self._uart_callbacks is not None:
+                # Interrupted before the connection was finished.
+                self._uart_callbacks = None
+                self._stop_connecting()
+
+    def start_connect_uart(
+        self, name="robot", on_disconnect=None, on_notify=None, on_write_done=None, time_out=10
+    ):
         """
+        Start connecting to a UART peripheral and return right away. Call
+        :meth:`poll_connect_uart` until it returns the handles. Takes the same
+        parameters as :meth:`connect_uart`.
+
+        :return: False if another connection attempt is still running. True otherwise.
+        """
+        if self._is_connecting():
+            return False
+
         # TODO: Create a generic connecting function that encodes the searched-for advertising data
         # self._search_payload = _advertising_payload(name=name, services=[_UART_UUID])
         # and searches for a match.
         # Then make connect_uart and connect_lego call that DRYer function.
 
         self._search_name = name
+        self._scan_match = lambda adv_name, services: (adv_name == name and _UART_UUID in services)
+        self._uart_callbacks = (on_notify, on_disconnect, on_write_done)
         self.connecting_uart = True
-        self._conn_handle = None
-        self._start_handle = None
-        self._end_handle = None
-        self._rx_handle = None
-        self._tx_handle = None
-        self._addr_type = None
-        self._addr = None
+        self._connection.reset_uart()
 
+        if not self.debug:
+            print("Connecting to UART Peripheral:", name)
+        self._connect_deadline = ticks_add(ticks_ms(), time_out * 1000)
         self.scan()
-        for i in range(time_out):
+        return True
 
-            if self.debug:
-                self.print_log()
-            else:
-                print("Connecting to UART Peripheral:", name)
-            sleep_ms(1000)
-            if not self.connecting_uart:
+    def poll_connect_uart(self):
+        """
+        Check on a connection started with :meth:`start_connect_uart`. Once it is done,
+        this registers the callbacks and negotiates the packet size.
+
+        :return: None while still connecting. Then conn_handle, rx_handle, tx_handle. All None if no peripheral was connected.
+        """
+        if self.connecting_uart and ticks_diff(self._connect_deadline, ticks_ms()) > 0:
+            return None
+        callbacks = self._uart_callbacks
+        handles = self._connection.handles()
+        conn_handle = handles[0]
+        if callbacks is not None:
+            self._uart_callbacks = None
+            # Stop a running scan before the MTU exchange. They share the radio.
+            self._stop_connecting()
+            if handles[1] is not None:
+                self._register_conn_callbacks(conn_handle, *callbacks)
+
+                self._negotiate_mtu(conn_handle)
+
+        if conn_handle is None:
+            return _NO_HANDLES
+        return handles
+
+    def _wait_connecting(self, deadline):
+        """
+        Wait until the IRQ handler is done connecting, or until the ticks_ms() deadline.
+        The IRQ handler clears connecting_uart or connecting_lego when all handles are
+        found, or when the scan ended without a match. Checks every _CONNECT_POLL_MS
+        and never sleeps past the deadline. Prints the debug log once per second.
+        """
+        next_log = ticks_ms()
+        while self.connecting_uart or self.connecting_lego:
+            now = ticks_ms()
+            remaining = ticks_diff(deadline, now)
+            if remaining <= 0:
                 break
-        if self._rx_handle:
-            self._notify_callbacks[self._conn_handle] = on_notify
-            self._disconn_callbacks[self._conn_handle] = on_disconnect
-            self._write_done_callbacks[self._conn_handle] = on_write_done
-
-            # Increase packet size
-            self._ble.config(mtu=TARGET_MTU)
-            self._ble.gattc_exchange_mtu(self._conn_handle)
-            sleep_ms(60)
-            # Store the result of the mtu negotiation.
-            self.mtu = self._ble.config("mtu") - 4  # Some overhead bytes in max msg size.
+            if self.debug and ticks_diff(now, next_log) >= 0:
+                next_log = ticks_add(next_log, 1000)
+                self.print_log()
+            sleep_ms(min(remaining, _CONNECT_POLL_MS))
+
+    def _is_connecting(self):
+        """
+        True while a connection attempt is running. A started UART connection
+        counts until poll_connect_uart() has finished it.
+        """
+        return self.connecting_uart or self.connecting_lego or self._uart_callbacks is not None
 
+    def _stop_connecting(self):
+        """End a connection attempt, successful or not."""
         self.connecting_uart = False
-        return self._conn_handle, self._rx_handle, self._tx_handle
+        self.connecting_lego = False
+        self._scan_match = _no_match
+        if self._scanning:
+            # Timed out while still scanning. Don't leave the radio busy.
+            self.stop_scan()
+
+    def _negotiate_mtu(self, conn_handle, time_out_ms=60):
+        """
+        Increase the packet size of a connection to a peripheral. Waits until the
+        peripheral answered, or at most time_out_ms milliseconds.
+        The IRQ handler stores the negotiated size in the slot of the connection.
+        If the exchange is refused or unanswered, :meth:`conn_mtu` stays at the default.
+        """
+        ble = self._ble
+        if not self._mtu_configured:
+            # The preferred mtu is a stack setting. It only needs to be set once.
+            ble.config(mtu=TARGET_MTU)
+            self._mtu_configured = True
+        self._mtu_conn = conn_handle
+        self._mtu_exchanged = False
+        try:
+            ble.gattc_exchange_mtu(conn_handle)
+        except OSError:
+            # The stack refused, e.g. because the mtu was already exchanged.
+            # Don't wait for an answer that won't come.
+            self._mtu_exchanged = True
+        deadline = ticks_add(ticks_ms(), time_out_ms)
+        while not self._mtu_exchanged and ticks_diff(deadline, ticks_ms()) > 0:
+            sleep_ms(1)
+        self._mtu_conn = _NO_CONN
 
     def connect_lego(self, time_out=10):
         """
         Connect to a LEGO Smart Hub that advertises with a LEGO service.
         LEGO Hubs are advertising when their leds are blinking, just after turning them on.
+
+        :return: The conn_handle. None if no hub was connected, or if another connection attempt is still running.
         """
+        if self._is_connecting():
+            return None
+        self._scan_match = _is_lego_hub
         self.connecting_lego = True
-        self._conn_handle = None
-        self._start_handle = None
-        self._end_handle = None
-        self._lego_value_handle = None
-        self._addr_type = None
-        self._addr = None
+        self._connection.reset()
+        if not self.debug:
+            print("Connecting to a LEGO Smart Hub...")
         self.scan()
-        for i in range(time_out):
-            if self.debug:
-                self.print_log()
-            else:
-                print("Connecting to a LEGO Smart Hub...")
-            sleep_ms(1000)
-            if not self.connecting_lego:
-                break
-        self.connecting_lego = False
-        return self._conn_handle
+        try:
+            self._wait_connecting(ticks_add(ticks_ms(), time_out * 1000))
+        finally:
+            self._stop_connecting()
+        return self._connection.conn_handle
+
+    def disconnect(self, conn_handle=None):
+        """
+        Disconnect from a peripheral. The disconnect callback of the connection
+        is called when the peripheral has disconnected.
+
+        :param conn_handle: The handle of the connection. Defaults to the last connected peripheral.
+        :type conn_handle: int
+        """
+        ctx = self._connection
+        if conn_handle is None:
+            conn_handle = ctx.conn_handle
+        if conn_handle is None:
+            # Not connected, or the peripheral already dropped the link.
+            return
+        if conn_handle == ctx.conn_handle:
+            ctx.release()
+            self._connection = ConnectionContext.acquire()
+        try:
+            self._ble.gap_disconnect(conn_handle)
+        except OSError:
+            pass  # The link was already gone.
 
     def uart_write(self, value, conn_handle, rx_handle=12, response=False):
         self._ble.gattc_write(conn_handle, rx_handle, value, 1 if response else 0)
         self.info("GATTC Written ", value)
 
     def lego_write(self, value, conn_handle=None, response=False):
+        lego_value_handle = self._connection.lego_value_handle
         if not conn_handle:
-            conn_handle = self._conn_handle
-        if self._lego_value_handle and conn_handle is not None:
-            self._ble.gattc_write(conn_handle, self._lego_value_handle, value, 1 if response else 0)
+            conn_handle = self._connection.conn_handle
+        if lego_value_handle and conn_handle is not None:
+            self._ble.gattc_write(conn_handle, lego_value_handle, value, 1 if response else 0)
             self.info("GATTC Written ", value)
 
     def enable_notify(self, conn_handle, desc_handle, callback=None):
         self._ble.gattc_write(conn_handle, desc_handle, struct.pack("<h", _NOTIFY_ENABLE), 0)
         if callback:
-            self._notify_callbacks[conn_handle] = callback
+            self._set_conn_callback(conn_handle, _SLOT_NOTIFY, callback)
 
 
 class MidiController:
@@ -912,7 +1414,8 @@ class UARTPeripheral(BleUARTBase):
         )
 
         self.ble_handler.on_write(self._handle_rx, self._on_rx)
-        self.ble_handler_central_disconn_callback = self._on_disconnect
+        self.ble_handler.on_central_connect(self._on_connect)
+        self.ble_handler.on_central_disconnect(self._on_disconnect)
 
         # Characteristics and descriptors have a default maximum size of 20 bytes.
         # Anything written to them by a client will be truncated to this length.
@@ -948,6 +1451,10 @@ class UARTPeripheral(BleUARTBase):
             self.start_advertising()
             return False
 
+    def _on_connect(self, conn_handle, addr_type, addr):
+        # The stack stops advertising when a central connects.
+        self._advertising = False
+
     def _on_disconnect(self, conn_handle):
         # Flush buffer
         self.read()
@@ -980,6 +1487,9 @@ class UARTCentral(BleUARTBase):
         if ble_handler is None:
             ble_handler = BLEHandler()
         self.ble_handler = ble_handler
+        # Bound once for fast_write(), which can be called every few milliseconds.
+        self._uart_write = ble_handler.uart_write
+        self._connect_pending = False  # Set by start_connect() until poll_connect() is done
 
         self._on_disconnect()
 
@@ -992,6 +1502,7 @@ class UARTCentral(BleUARTBase):
         self._periph_name = None
         self._tx_handle = 9  # None
         self._rx_handle = 12  # None
+        self._mtu = _DEFAULT_MTU
         self.writing = False
         self.reading = False
 
@@ -1015,14 +1526,55 @@ class UARTCentral(BleUARTBase):
             on_notify=self._on_rx,
             on_write_done=self._on_write_done,
         )  # Blocks until timeout or device with the right name found
+        self._mtu = self.ble_handler.conn_mtu(self._conn_handle)
         return self.is_connected()
 
+    def start_connect(self, name="robot", time_out=10):
+        """
+        Start searching for and connecting to a peripheral with a given name, and
+        return right away. Call :meth:`poll_connect` until it returns True.
+
+        :param name: The name of the peripheral to connect to
+        :type name: str
+        :param time_out: Seconds to search and connect
+        :type time_out: int
+        :return: False if the ble handler is still busy with another connection attempt.
+        """
+        if not self.ble_handler.start_connect_uart(
+            name,
+            on_disconnect=self._on_disconnect,
+            on_notify=self._on_rx,
+            on_write_done=self._on_write_done,
+            time_out=time_out,
+        ):
+            return False
+        self._periph_name = name
+        self._connect_pending = True
+        return True
+
+    def poll_connect(self):
+        """
+        Check on a connection started with :meth:`start_connect`.
+        Returns True when done, connected or not. Use :meth:`is_connected` to find out which.
+        Also returns True if this central has no connection attempt running.
+        """
+        if not self._connect_pending:
+            # Don't finish a connection that another central started.
+            return True
+        handles = self.ble_handler.poll_connect_uart()
+        if handles is None:
+            return False
+        self._connect_pending = False
+        self._conn_handle, self._rx_handle, self._tx_handle = handles
+        self._mtu = self.ble_handler.conn_mtu(self._conn_handle)
+        return True
+
     def is_connected(self):
         return self._conn_handle is not None
 
     def disconnect(self):
         if self.is_connected():
-            self.ble_handler._ble.gap_disconnect(self._conn_handle)
+            self.ble_handler.disconnect(self._conn_handle)
 
     def write(self, data):
         """
@@ -1032,17 +1584,19 @@ class UARTCentral(BleUARTBase):
         :type data: bytes
         """
         if self.is_connected():
+            mtu = self._mtu
+            uart_write = self.ble_handler.uart_write
+            conn_handle = self._conn_handle
+            rx_handle = self._rx_handle
             try:
                 # Chop data in mtu-sizes packages
-                for i in range(0, len(data), self.ble_handler.mtu):
+                for i in range(0, len(data), mtu):
                     tries = 0
                     while tries < 50:
                         if not self.writing:  # Only send when writing is done
                             self.writing = True
-                            partial = data[i : i + self.ble_handler.mtu]
-                            self.ble_handler.uart_write(
-                                partial, self._conn_handle, self._rx_handle, response=True
-                            )
+                            partial = data[i : i + mtu]
+                            uart_write(partial, conn_handle, rx_handle, response=True)
                             break
                         else:
                             # Wait some more until writing is done.
@@ -1061,15 +1615,47 @@ class UARTCentral(BleUARTBase):
         :param data: The data to write to the peripheral
         :type data: bytes
         """
-        if self.is_connected():
+        if self._conn_handle is not None:
             try:
-                self.ble_handler.uart_write(
-                    data[: self.ble_handler.mtu], self._conn_handle, self._rx_handle, response=False
-                )
+                self._uart_write(data[: self._mtu], self._conn_handle, self._rx_handle, False)
 
             except Exception as e:
                 print("Error writing:", e, data)
 
+    def write_many(self, chunks):
+        """
+        Write a sequence of small messages to server/peripheral as fast as possible. Non-blocking.
+        Adjacent chunks are packed together into packets of up to mtu bytes, so ten short
+        messages can go out as one packet instead of ten.
+        - Chunks longer than mtu are split over several packets
+        - No pause after writing, like fast_write(). Be careful
+
+        :param chunks: The messages to write to the peripheral
+        :type chunks: iterable of bytes or str
+        """
+        conn_handle = self._conn_handle
+        if conn_handle is not None:
+            uart_write = self._uart_write
+            mtu = self._mtu
+            rx_handle = self._rx_handle
+            buf = bytearray()
+            try:
+                for chunk in chunks:
+                    if isinstance(chunk, str):
+                        chunk = bytes(chunk, "utf8")
+                    if buf and len(buf) + len(chunk) > mtu:
+                        uart_write(bytes(buf), conn_handle, rx_handle, False)
+                        buf = bytearray()
+                    buf.extend(chunk)
+                    while len(buf) > mtu:
+                        uart_write(bytes(buf[:mtu]), conn_handle, rx_handle, False)
+                        buf = buf[mtu:]
+                if buf:
+                    uart_write(bytes(buf), conn_handle, rx_handle, False)
+
+            except Exception as e:
+                print("Error writing:", e, chunks)
+
 
 class RCReceiver(UARTPeripheral):
     """
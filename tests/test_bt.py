@@ -0,0 +1,532 @@
+"""Tests for BLEHandler internals."""
+
+import pytest
+from unittest.mock import Mock, patch
+
+
+@pytest.fixture
+def ble_handler():
+    """BLEHandler with a mocked ubluetooth.BLE radio."""
+    from btbricks import bt
+
+    with patch.object(bt.ubluetooth, "BLE", create=True):
+        yield bt.BLEHandler()
+
+
+@pytest.fixture
+def fake_clock():
+    """
+    Fake utime clock in bt. sleep_ms() advances clock["ms"] and then calls
+    clock["on_sleep"](ms), if a test has set it.
+    """
+    from btbricks import bt
+
+    clock = {"ms": 0, "on_sleep": None}
+
+    def sleep_ms(ms):
+        clock["ms"] += ms
+        if clock["on_sleep"]:
+            clock["on_sleep"](clock["ms"])
+
+    with patch.multiple(
+        bt,
+        sleep_ms=sleep_ms,
+        ticks_ms=lambda: clock["ms"],
+        ticks_add=lambda a, b: a + b,
+        ticks_diff=lambda a, b: a - b,
+    ):
+        yield clock
+
+
+class TestConnectionCallbacks:
+    """Test per-connection callback slots."""
+
+    def test_slots_are_preallocated(self, ble_handler):
+        """Test that the callback table does not grow for a few connections."""
+        from btbricks.bt import _MAX_CONN
+
+        slot_ids = [id(slot) for slot in ble_handler._conn_slots]
+        for conn_handle in range(_MAX_CONN):
+            ble_handler.on_write_done(conn_handle, Mock())
+        assert [id(slot) for slot in ble_handler._conn_slots] == slot_ids
+
+    def test_extra_slot_when_table_full(self, ble_handler):
+        """Test that more connections than preallocated slots still get a slot."""
+        from btbricks.bt import _MAX_CONN
+
+        for conn_handle in range(_MAX_CONN + 1):
+            ble_handler.on_write_done(conn_handle, Mock())
+        assert ble_handler._conn_slot(_MAX_CONN) is not None
+
+    def test_write_done_dispatch(self, ble_handler):
+        """Test that write done events reach the callback of the connection."""
+        from btbricks.bt import _IRQ_GATTC_WRITE_DONE
+
+        callback = Mock()
+        ble_handler.on_write_done(64, callback)
+        ble_handler._irq(_IRQ_GATTC_WRITE_DONE, (64, 12, 0))
+        ble_handler._irq(_IRQ_GATTC_WRITE_DONE, (65, 12, 0))
+        callback.assert_called_once_with(12, 0)
+
+    def test_disconnect_clears_slot(self, ble_handler):
+        """Test that a peripheral disconnect fires the callback and frees the slot."""
+        from btbricks.bt import _IRQ_PERIPHERAL_DISCONNECT, _SLOT_DISCONN
+
+        on_disconnect = Mock()
+        ble_handler.on_write_done(64, Mock())
+        ble_handler._set_conn_callback(64, _SLOT_DISCONN, on_disconnect)
+        ble_handler._irq(_IRQ_PERIPHERAL_DISCONNECT, (64, 0, b""))
+        on_disconnect.assert_called_once_with()
+        assert ble_handler._conn_slot(64) is None
+
+    def test_register_replaces_all_callbacks(self, ble_handler):
+        """Test that registering a new connection overwrites stale callbacks."""
+        from btbricks.bt import _SLOT_NOTIFY, _SLOT_DISCONN, _SLOT_WRITE_DONE
+
+        ble_handler.on_write_done(64, Mock())
+        notify = Mock()
+        ble_handler._register_conn_callbacks(64, notify=notify)
+        slot = ble_handler._conn_slot(64)
+        assert slot[_SLOT_NOTIFY] is notify
+        assert slot[_SLOT_DISCONN] is None
+        assert slot[_SLOT_WRITE_DONE] is None
+
+
+class TestHandlerCallbacks:
+    """Test handler-wide callbacks."""
+
+    def test_central_connect_and_disconnect(self, ble_handler):
+        """Test that central (dis)connect events reach their registered callbacks."""
+        from btbricks.bt import _IRQ_CENTRAL_CONNECT, _IRQ_CENTRAL_DISCONNECT
+
+        on_connect, on_disconnect = Mock(), Mock()
+        ble_handler.on_central_connect(on_connect)
+        ble_handler.on_central_disconnect(on_disconnect)
+        ble_handler._irq(_IRQ_CENTRAL_CONNECT, (3, 0, b""))
+        assert ble_handler._connected_central == 3
+        on_connect.assert_called_once_with(3, 0, b"")
+        ble_handler._irq(_IRQ_CENTRAL_DISCONNECT, (3, 0, b""))
+        on_disconnect.assert_called_once_with(3)
+
+
+class TestWeakCallbacks:
+    """Test that registered bound methods do not keep their owner alive."""
+
+    class Owner:
+        def __init__(self):
+            self.calls = []
+
+        def on_write_done(self, value_handle, status):
+            self.calls.append((value_handle, status))
+
+    def test_bound_method_dispatch(self, ble_handler):
+        """Test that a weakly held bound method is still called while its owner lives."""
+        from btbricks.bt import _IRQ_GATTC_WRITE_DONE
+
+        owner = self.Owner()
+        ble_handler.on_write_done(1, owner.on_write_done)
+        ble_handler._irq(_IRQ_GATTC_WRITE_DONE, (1, 12, 0))
+        assert owner.calls == [(12, 0)]
+
+    def test_dead_owner_clears_entry(self, ble_handler):
+        """Test that collecting the owner clears the registered callback."""
+        import gc
+        from btbricks.bt import _IRQ_GATTC_WRITE_DONE, _SLOT_WRITE_DONE
+
+        owner = self.Owner()
+        ble_handler.on_write_done(1, owner.on_write_done)
+        del owner
+        gc.collect()
+        assert ble_handler._conn_slot(1)[_SLOT_WRITE_DONE] is None
+        ble_handler._irq(_IRQ_GATTC_WRITE_DONE, (1, 12, 0))
+
+    def test_plain_function_kept(self, ble_handler):
+        """Test that plain functions and lambdas are stored as they are."""
+        callback = lambda value: None
+        ble_handler.on_write(5, callback)
+        assert ble_handler._write_callbacks[5] is callback
+
+    def test_dead_owner_drops_write_callback(self, ble_handler):
+        """Test that collecting the owner removes its write callback key."""
+        import gc
+
+        owner = self.Owner()
+        ble_handler.on_write(5, owner.on_write_done)
+        del owner
+        gc.collect()
+        assert 5 not in ble_handler._write_callbacks
+
+    def test_sweep_frees_dead_slots(self, ble_handler):
+        """Test that a disconnect sweeps slots and extra table entries without live callbacks."""
+        import gc
+        from btbricks.bt import _MAX_CONN
+
+        owners = [self.Owner() for _ in range(_MAX_CONN + 1)]
+        for conn_handle, owner in enumerate(owners):
+            ble_handler.on_write_done(conn_handle, owner.on_write_done)
+        del owner
+        owners = owners[:1]
+        gc.collect()
+        ble_handler._clear_connection(99)
+        assert len(ble_handler._conn_slots) == _MAX_CONN
+        assert ble_handler._conn_slot(0) is not None
+        assert ble_handler._conn_slot(1) is None
+
+    def test_no_resolve_without_weakmethod(self, ble_handler):
+        """Test that dispatch skips _resolve() where weak references are not available."""
+        from btbricks import bt
+
+        owner = self.Owner()
+        with patch.multiple(bt, WeakMethod=None, _resolve=Mock()):
+            ble_handler.on_write_done(64, owner.on_write_done)
+            ble_handler._irq(bt._IRQ_GATTC_WRITE_DONE, (64, 12, 0))
+            bt._resolve.assert_not_called()
+        assert owner.calls == [(12, 0)]
+
+
+class TestConnectionContext:
+    """Test the packed connection state."""
+
+    def test_handles_unset_after_reset(self):
+        """Test that all handles read as None on a fresh context."""
+        from btbricks.bt import ConnectionContext
+
+        ctx = ConnectionContext()
+        assert ctx.conn_handle is None
+        assert ctx.lego_value_handle is None
+        assert not ctx.is_uart_ready()
+        assert not ctx.has_discovery_handles()
+
+    def test_handles_round_trip(self):
+        """Test that uint16 handles, including 0, are stored and read back."""
+        from btbricks.bt import ConnectionContext
+
+        ctx = ConnectionContext()
+        ctx.conn_handle = 0
+        ctx.uart_rx_handle = 0x0E00
+        ctx.uart_tx_handle = 9
+        assert ctx.handles() == (0, 0x0E00, 9)
+        assert ctx.is_uart_ready()
+        ctx.reset()
+        assert ctx.handles() == (None, None, None)
+
+    def test_no_instance_dict(self):
+        """Test that the context does not carry a per-instance dict."""
+        from btbricks.bt import ConnectionContext
+
+        assert not hasattr(ConnectionContext(), "__dict__")
+
+    def test_pool_reuses_released_context(self):
+        """Test that a released context is reset and handed out again."""
+        from btbricks.bt import ConnectionContext, _CTX_POOL
+
+        _CTX_POOL.clear()
+        ctx = ConnectionContext.acquire()
+        ctx.conn_handle = 64
+        ctx.release()
+        assert ConnectionContext.acquire() is ctx
+        assert ctx.conn_handle is None
+
+    def test_disconnect_releases_context(self, ble_handler):
+        """Test that disconnecting the current peripheral resets the connection state."""
+        ble_handler._connection.conn_handle = 64
+        ble_handler._connection.lego_value_handle = 14
+        ble_handler.disconnect()
+        ble_handler._ble.gap_disconnect.assert_called_with(64)
+        assert ble_handler._connection.lego_value_handle is None
+
+    def test_disconnect_after_peer_dropped(self, ble_handler):
+        """Test that disconnect skips the radio when the peripheral already disconnected."""
+        from btbricks.bt import _IRQ_PERIPHERAL_DISCONNECT
+
+        ble_handler._connection.conn_handle = 64
+        ble_handler._irq(_IRQ_PERIPHERAL_DISCONNECT, (64, 0, b""))
+        ble_handler.disconnect()
+        ble_handler._ble.gap_disconnect.assert_called_once_with(1025)  # Only the one from __init__
+
+
+class TestScanResult:
+    """Test advertisement matching while connecting."""
+
+    def test_lego_hub_matched_once(self, ble_handler):
+        """Test that the first LEGO advertisement is stored and stops the scan."""
+        from btbricks import bt
+
+        services = [bt._LEGO_SERVICE_UUID]
+        with patch.object(bt, "_decode_services", return_value=services):
+            ble_handler._scan_match = bt._is_lego_hub
+            ble_handler._irq(bt._IRQ_SCAN_RESULT, (0, b"\x01" * 6, 0, -50, b""))
+            ble_handler._irq(bt._IRQ_SCAN_RESULT, (0, b"\x02" * 6, 0, -50, b""))
+        assert ble_handler._connection.addr == b"\x01" * 6
+        ble_handler._ble.gap_scan.assert_called_once_with(None)
+
+    def test_no_match_when_not_connecting(self, ble_handler):
+        """Test that advertisements are ignored when no connection is being set up."""
+        from btbricks import bt
+
+        with patch.object(bt, "_decode_services", return_value=[bt._LEGO_SERVICE_UUID]):
+            ble_handler._irq(bt._IRQ_SCAN_RESULT, (0, b"\x01" * 6, 0, -50, b""))
+        assert ble_handler._connection.addr_type is None
+
+
+class TestConnectLego:
+    """Test the connect_lego wait loop."""
+
+    def test_returns_as_soon_as_connected(self, ble_handler, fake_clock):
+        """Test that connect_lego stops polling once the IRQ handler is done."""
+
+        def on_sleep(ms):
+            if ms >= 200:
+                ble_handler._connection.conn_handle = 64
+                ble_handler.connecting_lego = False
+
+        fake_clock["on_sleep"] = on_sleep
+        assert ble_handler.connect_lego(time_out=10) == 64
+        assert fake_clock["ms"] < 1000
+
+    def test_no_stop_scan_after_scan_done(self, ble_handler):
+        """Test that a scan that already ended is not stopped again."""
+        from btbricks import bt
+
+        def sleep_ms(ms):
+            ble_handler._irq(bt._IRQ_SCAN_DONE, (0,))
+
+        with patch.object(bt, "sleep_ms", sleep_ms):
+            ble_handler.connect_lego(time_out=1)
+        ble_handler._ble.gap_scan.assert_called_once_with(20000, 30000, 30000)
+
+    def test_times_out_on_deadline(self, ble_handler, fake_clock):
+        """Test that connect_lego gives up exactly at the deadline."""
+        assert ble_handler.connect_lego(time_out=1) is None
+        assert fake_clock["ms"] == 1000
+        assert ble_handler.connecting_lego is False
+        ble_handler._ble.gap_scan.assert_called_with(None)
+
+
+class TestUARTPeripheral:
+    """Test UARTPeripheral wiring to the handler."""
+
+    def test_central_disconnect_flushes_and_advertises(self, ble_handler):
+        """Test that a central disconnect flushes the buffer and restarts advertising."""
+        from btbricks import bt
+        from btbricks.bt import UARTPeripheral, _IRQ_CENTRAL_CONNECT, _IRQ_CENTRAL_DISCONNECT
+
+        ble_handler._ble.gatts_register_services.return_value = ((1, 2),)
+        with patch.object(bt, "advertising_payload"):
+            uart = UARTPeripheral(ble_handler=ble_handler)
+        ble_handler._irq(_IRQ_CENTRAL_CONNECT, (0, 0, b""))
+        assert uart.is_connected()
+        uart.read_buffer = b"stale"
+        ble_handler._ble.gap_advertise.reset_mock()
+        with patch.object(bt, "advertising_payload"):
+            ble_handler._irq(_IRQ_CENTRAL_DISCONNECT, (0, 0, b""))
+        assert uart.any() == 0
+        ble_handler._ble.gap_advertise.assert_called_once()
+
+    def test_advertises_again_without_polling(self, ble_handler):
+        """Test that advertising restarts after every disconnect without is_connected() calls."""
+        from btbricks import bt
+        from btbricks.bt import UARTPeripheral, _IRQ_CENTRAL_CONNECT, _IRQ_CENTRAL_DISCONNECT
+
+        ble_handler._ble.gatts_register_services.return_value = ((1, 2),)
+        with patch.object(bt, "advertising_payload"):
+            uart = UARTPeripheral(ble_handler=ble_handler)  # noqa: F841, callbacks are weak
+            for _ in range(2):
+                ble_handler._ble.gap_advertise.reset_mock()
+                ble_handler._irq(_IRQ_CENTRAL_CONNECT, (0, 0, b""))
+                ble_handler._irq(_IRQ_CENTRAL_DISCONNECT, (0, 0, b""))
+                ble_handler._ble.gap_advertise.assert_called_once()
+
+
+class TestNegotiateMtu:
+    """Test the MTU exchange after connecting to a UART peripheral."""
+
+    def test_stops_waiting_when_exchanged(self, ble_handler, fake_clock):
+        """Test that the wait ends as soon as the MTU exchange event arrives."""
+        from btbricks import bt
+
+        def on_sleep(ms):
+            if ms == 5:
+                ble_handler._irq(bt._IRQ_MTU_EXCHANGED, (64, 184))
+
+        fake_clock["on_sleep"] = on_sleep
+        ble_handler._negotiate_mtu(64)
+        assert fake_clock["ms"] == 5
+        ble_handler._ble.gattc_exchange_mtu.assert_called_once_with(64)
+        assert ble_handler.mtu == 180
+
+    def test_other_connection_does_not_end_wait(self, ble_handler, fake_clock):
+        """Test that an exchange on another connection does not end the wait."""
+        from btbricks import bt
+
+        def on_sleep(ms):
+            if ms == 5:
+                ble_handler._irq(bt._IRQ_MTU_EXCHANGED, (1, 247))
+
+        fake_clock["on_sleep"] = on_sleep
+        ble_handler._negotiate_mtu(64)
+        assert fake_clock["ms"] == 60
+
+    def test_refused_exchange_does_not_wait(self, ble_handler):
+        """Test that a refused MTU exchange neither raises nor waits."""
+        from btbricks import bt
+
+        sleeps = []
+        ble_handler._ble.gattc_exchange_mtu.side_effect = OSError(114)
+        with patch.object(bt, "sleep_ms", sleeps.append):
+            ble_handler._negotiate_mtu(64)
+        assert sleeps == []
+        assert ble_handler.mtu == 20
+
+    def test_mtu_kept_per_connection(self, ble_handler, fake_clock):
+        """Test that a refused exchange does not inherit the mtu of another peer."""
+        from btbricks import bt
+
+        ble_handler._register_conn_callbacks(64)
+        ble_handler._register_conn_callbacks(65)
+        fake_clock["on_sleep"] = lambda ms: ble_handler._irq(bt._IRQ_MTU_EXCHANGED, (64, 184))
+        ble_handler._negotiate_mtu(64)
+        ble_handler._ble.gattc_exchange_mtu.side_effect = OSError(114)
+        ble_handler._negotiate_mtu(65)
+        assert ble_handler.conn_mtu(64) == 180
+        assert ble_handler.conn_mtu(65) == 20
+
+    def test_preferred_mtu_set_once(self, ble_handler):
+        """Test that the preferred mtu is configured on the first exchange only."""
+        from btbricks import bt
+
+        ble_handler._ble.gattc_exchange_mtu.side_effect = OSError(114)
+        ble_handler._negotiate_mtu(64)
+        ble_handler._negotiate_mtu(65)
+        ble_handler._ble.config.assert_called_once_with(mtu=bt.TARGET_MTU)
+
+
+class TestConnectUart:
+    """Test connect_uart results."""
+
+    def test_failed_connect_returns_shared_tuple(self, ble_handler):
+        """Test that a failed connect returns the shared no-handles tuple."""
+        from btbricks import bt
+
+        with patch.object(bt, "sleep_ms"):
+            result = ble_handler.connect_uart("robot", time_out=0)
+        assert result is bt._NO_HANDLES
+        assert result == (None, None, None)
+
+    def test_start_and_poll(self, ble_handler):
+        """Test connecting without blocking through start_connect_uart and poll_connect_uart."""
+        from btbricks.bt import _SLOT_NOTIFY
+
+        on_notify = Mock()
+        ble_handler.start_connect_uart("robot", on_notify=on_notify)
+        assert ble_handler.poll_connect_uart() is None
+
+        # What the IRQ handler does once the UART characteristics are found
+        ctx = ble_handler._connection
+        ctx.conn_handle, ctx.uart_rx_handle, ctx.uart_tx_handle = 64, 12, 9
+        ble_handler.connecting_uart = False
+
+        with patch.object(ble_handler, "_negotiate_mtu") as negotiate_mtu:
+            assert ble_handler.poll_connect_uart() == (64, 12, 9)
+            assert ble_handler.poll_connect_uart() == (64, 12, 9)
+        negotiate_mtu.assert_called_once_with(64)
+        assert ble_handler._conn_slot(64)[_SLOT_NOTIFY] is on_notify
+
+    def test_scan_stopped_before_mtu_exchange(self, ble_handler):
+        """Test that a scan still running at the deadline is stopped before the MTU exchange."""
+        from btbricks import bt
+
+        ble_handler.start_connect_uart("robot", time_out=0)
+        ctx = ble_handler._connection
+        ctx.conn_handle, ctx.uart_rx_handle, ctx.uart_tx_handle = 64, 12, 9
+        calls = []
+        ble_handler._ble.gap_scan.side_effect = lambda *args: calls.append("scan")
+        ble_handler._ble.gattc_exchange_mtu.side_effect = lambda *args: calls.append("mtu")
+        with patch.object(bt, "sleep_ms"):
+            ble_handler.poll_connect_uart()
+        assert calls[:2] == ["scan", "mtu"]
+
+    def test_keeps_lego_hub_handle(self, ble_handler):
+        """Test that a hub connected earlier can still be written to after a UART connect."""
+        from btbricks import bt
+
+        ble_handler._connection.lego_value_handle = 14
+        with patch.object(bt, "sleep_ms"):
+            ble_handler.connect_uart("robot", time_out=0)
+        ble_handler.lego_write(b"x", 1)
+        ble_handler._ble.gattc_write.assert_called_once_with(1, 14, b"x", 0)
+
+    def test_busy_handler_refuses_second_connect(self, ble_handler):
+        """Test that a second connect does not start another scan while one is running."""
+        from btbricks import bt
+
+        assert ble_handler.start_connect_uart("robot") is True
+        ble_handler._ble.gap_scan.reset_mock()
+        assert ble_handler.connect_uart("other") is bt._NO_HANDLES
+        assert ble_handler.connect_lego() is None
+        ble_handler._ble.gap_scan.assert_not_called()
+
+    def test_interrupted_connect_clears_state(self, ble_handler):
+        """Test that an exception while waiting leaves the handler ready to connect again."""
+        from btbricks import bt
+
+        with patch.object(bt, "sleep_ms", side_effect=KeyboardInterrupt):
+            with pytest.raises(KeyboardInterrupt):
+                ble_handler.connect_uart("robot")
+        assert not ble_handler._is_connecting()
+
+
+class TestUARTCentral:
+    """Test UARTCentral connections and writes."""
+
+    def test_poll_connect_ignores_other_central(self, ble_handler):
+        """Test that a refused start does not pick up the connection of another central."""
+        from btbricks.bt import UARTCentral
+
+        first = UARTCentral(ble_handler=ble_handler)
+        second = UARTCentral(ble_handler=ble_handler)
+        assert first.start_connect("robot") is True
+        assert second.start_connect("other") is False
+        assert second._periph_name is None
+
+        ctx = ble_handler._connection
+        ctx.conn_handle, ctx.uart_rx_handle, ctx.uart_tx_handle = 64, 12, 9
+        ble_handler.connecting_uart = False
+        with patch.object(ble_handler, "_negotiate_mtu"):
+            assert second.poll_connect() is True
+            assert not second.is_connected()
+            assert first.poll_connect() is True
+        assert first.is_connected()
+        assert not second.is_connected()
+
+    def test_write_many_packs_chunks(self, ble_handler):
+        """Test that small chunks are packed and long chunks split into mtu-sized packets."""
+        from btbricks.bt import UARTCentral
+
+        uart = UARTCentral(ble_handler=ble_handler)
+        uart._conn_handle = 64
+        uart.write_many([b"a" * 8, "b" * 8, b"c" * 8, b"d" * 30])
+        written = [c.args[2] for c in ble_handler._ble.gattc_write.call_args_list]
+        assert written == [b"a" * 8 + b"b" * 8, b"c" * 8, b"d" * 20, b"d" * 10]
+
+
+class TestLog:
+    """Test the debug log."""
+
+    def test_drain_log_is_chronological(self):
+        """Test that a wrapped log drains oldest first and is cleared afterwards."""
+        from btbricks import bt
+
+        with patch.object(bt.ubluetooth, "BLE", create=True):
+            ble_handler = bt.BLEHandler(debug=True)
+        ble_handler.drain_log()
+        ble_handler.log_idx = ble_handler.log_size - 6
+        ble_handler.info("first")
+        ble_handler.info("second")
+        assert ble_handler.drain_log() == b"first\nsecond\n"
+        assert ble_handler.drain_log() == b""
+
+    def test_drain_log_without_debug(self, ble_handler):
+        """Test that the log is empty when debug is disabled."""
+        ble_handler.info("ignored")
+        assert ble_handler.drain_log() == b""